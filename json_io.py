@@ -0,0 +1,23 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
+
+
+def read_json(path: str):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def write_json(data, path: str) -> None:
+    """Write data as indented UTF-8 JSON."""
+    if orjson:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
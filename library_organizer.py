@@ -1,11 +1,121 @@
+import asyncio
 import json
+import textwrap
+import time
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 import anthropic
 
+from json_io import write_json
+from response_cache import ResponseCache
 from zotero_connector import ZoteroLibrary
 
+# Seconds between Message Batches status checks
+BATCH_POLL_INTERVAL = 20
+
+# Keywords per propose request; larger libraries are proposed in chunks and merged
+PROPOSE_CHUNK_SIZE = 400
+MAX_PROPOSED_COLLECTIONS = 100
+
+# Static prompt fragments; per-paper prompts are joined from these and the paper's fields
+KEYWORDS_PROMPT_HEAD = "Suggest 10 generic, reusable keywords for this "
+KEYWORDS_PROMPT_BODY = """.
+Terms should focus on the main topic, method, technique, concept, or subject.
+Not too broad terms. Don't generate too similar keywords (e.g. INSTEAD
+OF 'neo-institutionalism', 'institutional theoy', 'social institutions'
+just tag 'Neo-Institutionalism')
+Include only the most relevant keywords. If you are missing the abstract,
+don't state that you have no access to it. Just add keywords from the
+title instead, as far as possible.
+
+Title: """
+KEYWORDS_PROMPT_TAIL = """
+
+List only keywords, one per line."""
+
+CLASSIFY_PROMPT_HEAD = "Given this "
+CLASSIFY_PROMPT_TAIL = """
+
+List the most appropriate collections for this publication.
+Output only the exact collection paths, one per line.
+Do not include any explanation or conversational text.
+Choose between 1-3 most relevant collections."""
+COLLECTIONS_BLOCK_HEAD = "These are the available collections:\n"
+
+# Proposal prompts, filled in with str.format_map; dedented once here so no indentation is sent as tokens
+PROPOSE_RULES_TEMPLATE = textwrap.dedent("""\
+    You design hierarchical collection structures that organize the publications of a research library.
+
+    Library contains: {type_summary}
+
+    {field_context}
+
+    The structure should work well for different publication types (articles, books, reports, etc.).
+    Return ONLY valid JSON, with no trailing commas: an object whose keys are collection names and whose
+    values are objects holding their sub-collections ({{}} for a collection without sub-collections).
+    If a sub-collection is located with a parent collection called Battery Aging, don't repeat the word
+    Battery Aging in the sub-collection name, subcollection example: Aging Mechanisms, Black box Modelling...""")
+
+PROPOSE_CHUNK_TEMPLATE = textwrap.dedent("""\
+    Given these keywords from a research library:
+    {keywords}
+
+    Create a hierarchical collection structure as JSON to organize publications with these topics.
+    Limit the proposal to a maximum {limit} total collections.""")
+
+MERGE_TOP_LEVEL_TEMPLATE = textwrap.dedent("""\
+    These top-level collections were proposed separately for different parts of one research library:
+    {names}
+
+    Some of them overlap or are synonyms. Map every listed name to the top-level collection it should be
+    merged into: either one of the listed names or a better shared name.
+    Return ONLY a JSON object mapping each listed name to its target name.""")
+
+
+def _as_tree(structure) -> Dict:
+    """Normalize a proposed structure to nested {name: {sub-name: {...}}} dicts."""
+    if isinstance(structure, dict) and isinstance(structure.get('collections'), list):
+        structure = structure['collections']
+    if isinstance(structure, list):
+        tree = {}
+        for item in structure:
+            if isinstance(item, str):
+                tree[item] = {}
+            elif isinstance(item, dict) and 'name' in item:
+                tree[item['name']] = _as_tree(item.get('subcollections', {}))
+        return tree
+    if isinstance(structure, dict):
+        return {name: _as_tree(content) for name, content in structure.items()}
+    return {}
+
+
+def _merge_tree(target: Dict, tree: Dict) -> None:
+    """Recursively merge `tree` into `target`, combining collections with the same name."""
+    for name, subtree in tree.items():
+        _merge_tree(target.setdefault(name, {}), subtree)
+
+
+def _count_tree(tree: Dict) -> int:
+    return sum(1 + _count_tree(subtree) for subtree in tree.values())
+
+
+def _trim_tree(tree: Dict, budget: int) -> Dict:
+    """Keep at most `budget` collections, filling the tree level by level so the deepest ones go first."""
+    trimmed = {}
+    level = [(tree, trimmed)]
+    while level and budget > 0:
+        next_level = []
+        for source, target in level:
+            for name, subtree in source.items():
+                if budget == 0:
+                    break
+                target[name] = {}
+                budget -= 1
+                next_level.append((subtree, target[name]))
+        level = next_level
+    return trimmed
+
 
 @dataclass
 class ApiPricing:
@@ -15,11 +125,59 @@ class ApiPricing:
     output_price: float
 
 
+@dataclass
+class CollectionIndex:
+    """Collections available for classification, built once per run."""
+    collection_map: Dict[str, str]  # "Path/To/Collection" -> Key
+    collection_paths: List[str]
+    # Prompt block listing every path; built once so each request reuses the identical cached prefix
+    collections_block: str
+
+
+class RateLimiter:
+    """Leaky-bucket throttle for Anthropic requests/minute and input tokens/minute."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self._requests = self.request_capacity
+        self._tokens = self.token_capacity
+        self._last_refill = time.monotonic()
+        self._lock = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_refill) / 60
+        self._last_refill = now
+        self._requests = min(self.request_capacity, self._requests + elapsed_minutes * self.request_capacity)
+        self._tokens = min(self.token_capacity, self._tokens + elapsed_minutes * self.token_capacity)
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until one request and `tokens` input tokens fit in the budget."""
+        # Created lazily so the lock binds to the loop started by asyncio.run()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        tokens = min(tokens, self.token_capacity)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait_minutes = max((1 - self._requests) / self.request_capacity,
+                                   (tokens - self._tokens) / self.token_capacity)
+                await asyncio.sleep(wait_minutes * 60)
+
+
 class LibraryOrganizer:
     def __init__(self, config: dict, field_context: str = ""):
         self.client = anthropic.Client(api_key=config['anthropic_api_key'])
+        # Retries are handled (and throttled) in _complete; the SDK's own retries would stack on top
+        self.async_client = anthropic.AsyncAnthropic(api_key=config['anthropic_api_key'], max_retries=0)
         self.model = config['model']
-        self.field_context = field_context
+        self.field_context = field_context or config.get('field_context') or ''
         self.pricing = ApiPricing(
             input_price=config['api_pricing']['input'],
             cache_write_price=config['api_pricing']['cache_write'],
@@ -27,6 +185,51 @@ class LibraryOrganizer:
             output_price=config['api_pricing']['output']
         )
 
+        # Re-runs (e.g. after a crash) reuse earlier answers instead of paying for them again
+        self.response_cache = ResponseCache(config.get('response_cache', 'cache.db'))
+
+        rate_limits = config.get('rate_limits', {})
+        self.max_concurrency = rate_limits.get('max_concurrency', 8)
+        self.max_retries = rate_limits.get('max_retries', 5)
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=rate_limits.get('requests_per_minute', 50),
+            tokens_per_minute=rate_limits.get('tokens_per_minute', 50000)
+        )
+
+    def close(self) -> None:
+        """Release local resources (the response cache connection)."""
+        self.response_cache.close()
+
+    async def _complete(self, validate: Optional[Callable[[str], bool]] = None, **params) -> str:
+        """Send a throttled Messages API request, backing off exponentially on 429s and transient errors.
+
+        Responses are cached by a hash of the request parameters, so identical
+        requests are only paid for once. If `validate` is given, only responses it
+        accepts are cached; refusals and unparseable answers are requested again next run.
+        """
+        cache_key = ResponseCache.cache_key(params)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Rough input estimate (~4 characters per token) for the tokens/minute budget
+        estimated_tokens = (len(str(params.get('system', ''))) + len(str(params['messages']))) // 4
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = await self.async_client.messages.create(**params)
+                response_text = response.content[0].text
+                if validate is None or validate(response_text):
+                    self.response_cache.set(cache_key, response_text)
+                return response_text
+            except (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 2 ** attempt
+                print(f"Anthropic API request failed ({type(e).__name__}), retrying in {delay}s...")
+                await asyncio.sleep(delay)
+
     def _get_item_label(self, item_type: str) -> str:
         """Get human-readable label for item type."""
         labels = {
@@ -45,32 +248,24 @@ class LibraryOrganizer:
         }
         return labels.get(item_type, 'publication')
 
-    def improve_paper_keywords(self, paper_id: int, library: ZoteroLibrary) -> List[str]:
-        item = library.items[paper_id]
+    def _keywords_params(self, item) -> dict:
+        """Build the Messages API parameters for a keyword request."""
         item_label = self._get_item_label(item.item_type)
 
-        prompt = f"""Suggest 10 generic, reusable keywords for this {item_label}.
-        Terms should focus on the main topic, method, technique, concept, or subject.
-        Not too broad terms. Don't generate too similar keywords (e.g. INSTEAD 
-        OF 'neo-institutionalism', 'institutional theoy', 'social institutions'
-        just tag 'Neo-Institutionalism')
-        Include only the most relevant keywords. If you are missing the abstract,
-        don't state that you have no access to it. Just add keywords from the
-        title instead, as far as possible.
-
-        Title: {item.title}
-        {"Abstract: " + item.abstract if item.abstract else ""}
-        Type: {item.item_type}
+        parts = [KEYWORDS_PROMPT_HEAD, item_label, KEYWORDS_PROMPT_BODY, item.title]
+        if item.abstract:
+            parts += ("\nAbstract: ", item.abstract)
+        parts += ("\nType: ", item.item_type, KEYWORDS_PROMPT_TAIL)
+        prompt = "".join(parts)
 
-        List only keywords, one per line."""
-
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=800,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        return {
+            "model": self.model,
+            "max_tokens": 800,
+            "messages": [{"role": "user", "content": prompt}]
+        }
 
-        raw_lines = [k.strip() for k in response.content[0].text.split('\n') if k.strip()]
+    def _parse_keywords(self, response_text: str) -> List[str]:
+        raw_lines = [k.strip() for k in response_text.split('\n') if k.strip()]
         new_keywords = []
         
         for line in raw_lines:
@@ -88,20 +283,94 @@ class LibraryOrganizer:
             if clean_line:
                 new_keywords.append(clean_line)
 
-        if new_keywords:
-            try:
-                library.update_item_keywords(paper_id, new_keywords)
-                print(f"Added {len(new_keywords)} keywords to item {paper_id}")
-            except Exception as e:
-                print(f"Failed to update keywords for item {paper_id}: {e}")
-        else:
-            print(f"No valid keywords extracted for item {paper_id}. Raw response: {response.content[0].text[:100]}...")
-            
         return new_keywords
 
+    def _has_keywords(self, response_text: str) -> bool:
+        return bool(self._parse_keywords(response_text))
+
+    def _extract_keywords(self, paper_id: int, response_text: str) -> List[str]:
+        new_keywords = self._parse_keywords(response_text)
+        if not new_keywords:
+            print(f"No valid keywords extracted for item {paper_id}. Raw response: {response_text[:100]}...")
+        return new_keywords
+
+    def save_keywords(self, paper_id: int, library: ZoteroLibrary, new_keywords: List[str]) -> bool:
+        """Add the keywords to the item in Zotero. Returns whether the write succeeded."""
+        try:
+            library.update_item_keywords(paper_id, new_keywords)
+            print(f"Added {len(new_keywords)} keywords to item {paper_id}")
+            return True
+        except Exception as e:
+            print(f"Failed to update keywords for item {paper_id}: {e}")
+            return False
+
+    async def improve_paper_keywords(self, paper_id: int, library: ZoteroLibrary) -> List[str]:
+        """Generate new keywords for a paper. Saving them is left to the caller (see save_keywords)."""
+        item = library.items[paper_id]
+        response_text = await self._complete(self._has_keywords, **self._keywords_params(item))
+        return self._extract_keywords(paper_id, response_text)
+
+    def improve_paper_keywords_batch(self, paper_ids: List[int], library: ZoteroLibrary) -> Dict[int, List[str]]:
+        """Generate keywords for many papers through the Message Batches API (50% cheaper).
+
+        Returns the keywords of the papers whose keywords were saved to Zotero.
+        """
+        requests = [{"custom_id": str(pid), "params": self._keywords_params(library.items[pid])}
+                    for pid in paper_ids]
+        responses = self._run_batch(requests, self._has_keywords)
+
+        results = {}
+        for pid in paper_ids:
+            if str(pid) not in responses:
+                continue
+            new_keywords = self._extract_keywords(pid, responses[str(pid)])
+            if new_keywords and self.save_keywords(pid, library, new_keywords):
+                results[pid] = new_keywords
+        return results
+
+    def _run_batch(self, requests: List[dict], validate: Optional[Callable[[str], bool]] = None) -> Dict[str, str]:
+        """Submit requests as one message batch, wait for it, and return custom_id -> response text.
+
+        Requests with a cached response are answered locally and left out of the batch.
+        As in _complete, only responses accepted by `validate` are cached.
+        """
+        responses = {}
+        cache_keys = {}
+        pending = []
+        for request in requests:
+            cache_key = ResponseCache.cache_key(request['params'])
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                responses[request['custom_id']] = cached
+            else:
+                cache_keys[request['custom_id']] = cache_key
+                pending.append(request)
+
+        if responses:
+            print(f"Reusing {len(responses)} cached responses")
+        if not pending:
+            return responses
+
+        batch = self.client.messages.batches.create(requests=pending)
+        print(f"Submitted batch {batch.id} with {len(pending)} requests")
+
+        while batch.processing_status != 'ended':
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = self.client.messages.batches.retrieve(batch.id)
+            print(f"Batch {batch.id} status: {batch.processing_status}")
+
+        for entry in self.client.messages.batches.results(batch.id):
+            if entry.result.type == 'succeeded':
+                response_text = entry.result.message.content[0].text
+                if validate is None or validate(response_text):
+                    self.response_cache.set(cache_keys[entry.custom_id], response_text)
+                responses[entry.custom_id] = response_text
+            else:
+                print(f"Batch request for item {entry.custom_id} did not succeed: {entry.result.type}")
+        return responses
+
     def propose_collection_structure(self, library: ZoteroLibrary) -> Dict:
         keywords = sorted(library.get_all_keywords())
-        keywords_str = "\n".join(keywords)
 
         # Analyze item type distribution
         type_counts = {}
@@ -110,28 +379,88 @@ class LibraryOrganizer:
 
         type_summary = ", ".join([f"{count} {t}s" for t, count in type_counts.items()])
 
-        prompt = f"""Given these keywords from a research library:
-        {keywords_str}
-
-        Library contains: {type_summary}
-
-        {self.field_context if self.field_context else ''}
+        # Rules shared by every chunk request. They are too short for prompt caching to apply
+        # (the minimum cacheable prompt is 1024+ tokens), so they are sent as a plain system prompt.
+        system = PROPOSE_RULES_TEMPLATE.format_map({
+            "type_summary": type_summary,
+            "field_context": self.field_context
+        })
+
+        # Sorted keywords chunk by prefix, so related terms tend to land in the same request
+        chunks = [keywords[i:i + PROPOSE_CHUNK_SIZE] for i in range(0, len(keywords), PROPOSE_CHUNK_SIZE)] or [[]]
+        if len(chunks) > 1:
+            print(f"Proposing structure in {len(chunks)} chunks of up to {PROPOSE_CHUNK_SIZE} keywords")
+
+        structure = asyncio.run(self._propose_from_chunks(system, chunks))
+        return structure if structure else {"Error": "Failed to parse structure"}
+
+    async def _propose_from_chunks(self, system: str, chunks: List[List[str]]) -> Dict:
+        """Propose a sub-hierarchy per keyword chunk, then merge them under shared top-level collections."""
+        # Split the 100-collection budget across chunks, bounded like keywords and classify
+        limit = max(1, MAX_PROPOSED_COLLECTIONS // len(chunks))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def propose(chunk):
+            async with semaphore:
+                return await self._complete(self._has_structure, **self._propose_params(system, chunk, limit))
+
+        responses = await asyncio.gather(*(propose(chunk) for chunk in chunks))
+
+        merged = {}
+        for response_text in responses:
+            partial = self._parse_structure(response_text)
+            if partial is not None:
+                _merge_tree(merged, _as_tree(partial))
+
+        if len(chunks) > 1 and len(merged) > 1:
+            merged = await self._merge_top_level(merged)
+
+        # The model doesn't always respect the per-chunk limit, so enforce the total here
+        total = _count_tree(merged)
+        if total > MAX_PROPOSED_COLLECTIONS:
+            print(f"Trimming proposal from {total} to {MAX_PROPOSED_COLLECTIONS} collections")
+            merged = _trim_tree(merged, MAX_PROPOSED_COLLECTIONS)
+        return merged
+
+    def _propose_params(self, system: str, keywords: List[str], limit: int) -> dict:
+        prompt = PROPOSE_CHUNK_TEMPLATE.format_map({"keywords": "\n".join(keywords), "limit": limit})
+
+        return {
+            "model": self.model,
+            "max_tokens": 8000,
+            "temperature": 0,
+            "system": system,
+            "messages": [{"role": "user", "content": prompt}]
+        }
 
-        Create a hierarchical collection structure as JSON to organize publications with these topics.
-        The structure should work well for different publication types (articles, books, reports, etc.).
-        Return ONLY valid JSON, with no trailing commas. Limit the proposal to a maximum 100 total collections.
-        If a sub-collection is located with a parent collection called Battery Aging, don't repeat the word
-        Battery Aging in the sub-collection name, subcollection example: Aging Mechanisms, Black box Modelling..."""
+    async def _merge_top_level(self, merged: Dict) -> Dict:
+        """Ask the LLM to fold overlapping top-level collections from different chunks together."""
+        prompt = MERGE_TOP_LEVEL_TEMPLATE.format_map({"names": "\n".join(merged)})
 
-        response = self.client.messages.create(
+        response_text = await self._complete(
+            self._has_structure,
             model=self.model,
-            max_tokens=8000,
+            max_tokens=4000,
             temperature=0,
             messages=[{"role": "user", "content": prompt}]
         )
-
+        mapping = self._parse_structure(response_text)
+        if mapping is None:
+            return merged
+
+        normalized = {}
+        for name, subtree in merged.items():
+            target = mapping.get(name)
+            _merge_tree(normalized.setdefault(target if isinstance(target, str) and target else name, {}), subtree)
+        print(f"Merged {len(merged)} top-level collections into {len(normalized)}")
+        return normalized
+
+    def _has_structure(self, text: str) -> bool:
+        return self._parse_structure(text, verbose=False) is not None
+
+    def _parse_structure(self, text: str, verbose: bool = True) -> Optional[Dict]:
+        """Extract the JSON object from a model response, or None if there is none."""
         try:
-            text = response.content[0].text
             # Clean the text
             text = text.strip()
             # Remove any markdown formatting
@@ -141,35 +470,22 @@ class LibraryOrganizer:
                     text = text[4:]
                 text = text.strip()
 
-            # Find the complete JSON object
+            # Parse the first complete JSON object, ignoring any trailing text
             start = text.find('{')
-            count = 0
-            end = start
-
-            for i in range(start, len(text)):
-                if text[i] == '{':
-                    count += 1
-                elif text[i] == '}':
-                    count -= 1
-                    if count == 0:
-                        end = i + 1
-                        break
-
-            if start >= 0 and end > start:
-                json_str = text[start:end]
-                return json.loads(json_str)
-            else:
+            if start < 0:
                 raise ValueError("Could not find complete JSON object")
+            structure, _ = json.JSONDecoder().raw_decode(text, start)
+            return structure
 
         except Exception as e:
-            print(f"Error parsing JSON: {e}")
-            print("Raw response:", text[:200] + "..." if len(text) > 200 else text)
-            return {"Error": "Failed to parse structure"}
+            if verbose:
+                print(f"Error parsing JSON: {e}")
+                print("Raw response:", text[:200] + "..." if len(text) > 200 else text)
+            return None
 
     def save_proposal(self, structure: Dict, filepath: str = "collection_proposal.json") -> bool:
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(structure, f, indent=2, ensure_ascii=False)
+            write_json(structure, filepath)
             print(f"Saved proposal to {filepath}")
             return True
         except Exception as e:
@@ -196,11 +512,8 @@ class LibraryOrganizer:
             print(f"Error implementing collection structure: {e}")
             raise
 
-    def classify_paper_in_collections(self, paper_id: int, library: ZoteroLibrary,
-                                      structure_file: str = 'proposal.json') -> None:
-        """Classify a paper into appropriate collections using the LLM and update Zotero."""
-        item = library.items[paper_id]
-
+    def build_collection_index(self, library: ZoteroLibrary) -> CollectionIndex:
+        """Map collection paths to keys once per run; the collections don't change while classifying."""
         # Build a map of "Path/To/Collection" -> Key from the actual loaded library
         # This ensures we match against what actually exists in Zotero
         collection_map = {}
@@ -212,37 +525,40 @@ class LibraryOrganizer:
         collection_paths = sorted(list(collection_map.keys()))
         print(f"Mapped {len(collection_map)} collections from Zotero library")
 
-        if not collection_paths:
-            print("Warning: No collections found in library!")
-            return
+        collections_block = COLLECTIONS_BLOCK_HEAD + "\n".join(collection_paths)
+        return CollectionIndex(collection_map, collection_paths, collections_block)
 
-        # Get collection suggestions from LLM
+    def _classify_params(self, item, collection_index: CollectionIndex) -> dict:
+        """Build the Messages API parameters for a classification request.
+
+        The collection list is identical for every paper in a run, so it goes first
+        and is marked for prompt caching; only the paper block is billed in full.
+        """
         item_type_label = self._get_item_label(item.item_type)
 
-        prompt = f"""Given this {item_type_label}:
-        Title: {item.title}
-        {"Abstract: " + item.abstract if item.abstract else ""}
-        Keywords: {', '.join(item.keywords)}
-        Type: {item.item_type}
+        parts = [CLASSIFY_PROMPT_HEAD, item_type_label, ":\nTitle: ", item.title]
+        if item.abstract:
+            parts += ("\nAbstract: ", item.abstract)
+        parts += ("\nKeywords: ", ", ".join(item.keywords), "\nType: ", item.item_type, CLASSIFY_PROMPT_TAIL)
+        prompt = "".join(parts)
+
+        return {
+            "model": self.model,
+            "max_tokens": 500,
+            "temperature": 0,
+            "messages": [{"role": "user", "content": [
+                {"type": "text", "text": collection_index.collections_block, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt}
+            ]}]
+        }
 
-        And these available collections:
-        {chr(10).join(collection_paths)}
+    def _collection_validator(self, collection_index: CollectionIndex) -> Callable[[str], bool]:
+        """Accept classification responses that name at least one existing collection."""
+        return lambda text: bool(self._match_collections(text, collection_index.collection_map, verbose=False))
 
-        List the most appropriate collections for this publication.
-        Output only the exact collection paths, one per line.
-        Do not include any explanation or conversational text.
-        Choose between 1-3 most relevant collections."""
-
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=500,
-            temperature=0,
-            messages=[{"role": "user", "content": prompt}]
-        )
-
-        # Update paper collections in Zotero
-        llm_response = response.content[0].text
-        print(f"LLM suggested collections:\n{llm_response}")
+    def _match_collections(self, llm_response: str, collection_map: Dict[str, str], verbose: bool = True) -> List[str]:
+        if verbose:
+            print(f"LLM suggested collections:\n{llm_response}")
 
         lines = [line.strip() for line in llm_response.split('\n') if line.strip()]
         collection_keys = []
@@ -258,12 +574,84 @@ class LibraryOrganizer:
                     collection_keys.append(collection_map[clean_line])
                 else:
                     # Ignore conversational lines
-                    if '/' in line or line in collection_paths: # Only warn if it looks like a path
+                    if verbose and '/' in line: # Only warn if it looks like a path
                          print(f"Warning: Collection '{line}' not found in collection_map")
 
-        if collection_keys:
-            library.update_item_collections(paper_id, collection_keys)
-            matched_names = [library.collections[cid].name for cid in collection_keys if cid in library.collections]
-            print(f"Successfully classified into: {matched_names}")
-        else:
-            print("No matching collections found - paper not classified")
+        return collection_keys
+
+    def save_classifications(self, classifications: Dict[int, List[str]], library: ZoteroLibrary) -> List[int]:
+        """Write item_id -> collection keys to Zotero in as few API requests as possible.
+
+        Returns the IDs that are done: written successfully, or with no matching collection to write.
+        Unclassifiable papers count as done too, to prevent infinite loops on them.
+        Items whose write fails are reported and left out, so they are retried on the next run.
+        """
+        updates = {pid: keys for pid, keys in classifications.items() if keys}
+        written = set()
+        if updates:
+            try:
+                written.update(library.update_items_collections(updates))
+            except Exception as e:
+                print(f"Batched collection update failed: {e}")
+
+            # Fall back to single writes for the items of failed chunks, so one bad item
+            # doesn't sink the rest of its chunk
+            for pid in updates:
+                if pid in written:
+                    continue
+                try:
+                    library.update_item_collections(pid, updates[pid])
+                    written.add(pid)
+                except Exception as e:
+                    print(f"Failed to update collections for item {pid}: {e}")
+
+        done = []
+        for pid, collection_keys in classifications.items():
+            title = library.items[pid].title
+            if not collection_keys:
+                print(f"No matching collections found - {title} not classified")
+            elif pid in written:
+                matched_names = [library.collections[cid].name for cid in collection_keys if cid in library.collections]
+                print(f"Successfully classified {title} into: {matched_names}")
+            else:
+                continue
+            done.append(pid)
+        return done
+
+    async def classify_paper_in_collections(self, paper_id: int, library: ZoteroLibrary,
+                                            collection_index: CollectionIndex) -> List[str]:
+        """Ask the LLM which collections a paper belongs to. Returns the matched collection keys.
+
+        Nothing is written here; pass the result to save_classifications().
+        """
+        item = library.items[paper_id]
+
+        # Get collection suggestions from LLM
+        llm_response = await self._complete(
+            self._collection_validator(collection_index), **self._classify_params(item, collection_index))
+        return self._match_collections(llm_response, collection_index.collection_map)
+
+    def classify_papers_in_collections_batch(self, paper_ids: List[int], library: ZoteroLibrary) -> List[int]:
+        """Classify many papers through the Message Batches API (50% cheaper) and update Zotero.
+
+        Returns the IDs of the papers that are done: answered by the batch and saved (or unclassifiable).
+        Papers whose Zotero write failed are left out so the next run retries them.
+        """
+        collection_index = self.build_collection_index(library)
+
+        if not collection_index.collection_paths:
+            print("Warning: No collections found in library!")
+            return []
+
+        requests = [{"custom_id": str(pid), "params": self._classify_params(library.items[pid], collection_index)}
+                    for pid in paper_ids]
+        responses = self._run_batch(requests, self._collection_validator(collection_index))
+
+        classifications = {}
+        for pid in paper_ids:
+            if str(pid) not in responses:
+                continue
+            print(f"\nItem {pid}: {library.items[pid].title}")
+            classifications[pid] = self._match_collections(responses[str(pid)], collection_index.collection_map)
+
+        return self.save_classifications(classifications, library)
@@ -1,16 +1,18 @@
 import argparse
+import asyncio
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from zotero_connector import ZoteroLibrary
+from json_io import read_json
+from zotero_connector import API_WRITE_LIMIT, ZoteroLibrary
 from library_organizer import LibraryOrganizer
 from state_manager import StateManager
 
 
 def load_config(config_path: str = 'config.json') -> dict:
     try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
+        return read_json(config_path)
     except FileNotFoundError:
         print(f"Error: Config file not found at {config_path}")
         sys.exit(1)
@@ -33,23 +35,54 @@ def validate_config(config: dict) -> None:
         print("Warning: 'zotero_user_id' or 'zotero_api_key' missing. Write operations (API) will fail.")
 
 
-def generate_keywords(library: ZoteroLibrary, organizer: LibraryOrganizer, state_manager: StateManager) -> None:
+async def run_bounded(worker, jobs, limit: int) -> None:
+    """Run worker(*job) for every job concurrently, at most `limit` at a time."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(job):
+        async with semaphore:
+            await worker(*job)
+
+    await asyncio.gather(*(bounded(job) for job in jobs))
+
+
+def generate_keywords(library: ZoteroLibrary, organizer: LibraryOrganizer, state_manager: StateManager, batch: bool = False) -> None:
     """Generate new keywords for papers without collections."""
     unclassified = {pid: paper for pid, paper in library.items.items() if not paper.collections}
     print(f"Found {len(unclassified)} unclassified papers")
 
+    pending = {}
     for paper_id, paper in unclassified.items():
         if state_manager.is_processed(paper_id, 'keywords'):
             print(f"Skipping {paper.title} (already processed)")
             continue
+        pending[paper_id] = paper
 
-        print(f"\nProcessing: {paper.title}")
-        print(f"Original keywords: {', '.join(paper.keywords)}")
-        new_keywords = organizer.improve_paper_keywords(paper_id, library)
-        
-        if new_keywords:
+    if batch:
+        if not pending:
+            return
+        results = organizer.improve_paper_keywords_batch(list(pending), library)
+        for paper_id in results:
             state_manager.mark_processed(paper_id, 'keywords')
-            print(f"New keywords: {', '.join(new_keywords)}")
+        print(f"Generated keywords for {len(results)} of {len(pending)} papers")
+        return
+
+    # As in classify, Zotero writes run on a single worker thread, off the event loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        async def process(paper_id, paper):
+            print(f"\nProcessing: {paper.title}")
+            print(f"Original keywords: {', '.join(paper.keywords)}")
+            new_keywords = await organizer.improve_paper_keywords(paper_id, library)
+            if not new_keywords:
+                return
+
+            saved = await asyncio.get_running_loop().run_in_executor(
+                executor, organizer.save_keywords, paper_id, library, new_keywords)
+            if saved:
+                state_manager.mark_processed(paper_id, 'keywords')
+                print(f"New keywords for {paper.title}: {', '.join(new_keywords)}")
+
+        asyncio.run(run_bounded(process, pending.items(), organizer.max_concurrency))
 
 
 def propose_collections(library: ZoteroLibrary, organizer: LibraryOrganizer, output_path: str = "proposed_collections.json") -> None:
@@ -65,8 +98,7 @@ def propose_collections(library: ZoteroLibrary, organizer: LibraryOrganizer, out
 def implement_collections(library: ZoteroLibrary, organizer: LibraryOrganizer, structure_path: str) -> None:
     """Implement collection structure from JSON file."""
     try:
-        with open(structure_path, 'r') as f:
-            structure = json.load(f)
+        structure = read_json(structure_path)
         organizer.implement_collection_structure(structure, library)
         print("Successfully implemented new collection structure")
     except FileNotFoundError:
@@ -77,7 +109,43 @@ def implement_collections(library: ZoteroLibrary, organizer: LibraryOrganizer, s
         sys.exit(1)
 
 
-def classify_papers(library: ZoteroLibrary, organizer: LibraryOrganizer, state_manager: StateManager, structure_file: str = 'proposal.json', force: bool = False) -> None:
+async def write_classifications(queue: asyncio.Queue, library: ZoteroLibrary, organizer: LibraryOrganizer,
+                                state_manager: StateManager) -> None:
+    """Drain (paper_id, collection_keys) results from the queue and write them to Zotero in batches.
+
+    Writes run on a single worker thread, so LLM requests keep flowing while Zotero is being updated.
+    A None entry marks the end of the results.
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        finished = False
+        while not finished:
+            pending = {}
+            entry = await queue.get()
+            # Take whatever else is already waiting, up to one API write request's worth
+            while True:
+                if entry is None:
+                    finished = True
+                    break
+                paper_id, collection_keys = entry
+                pending[paper_id] = collection_keys
+                if len(pending) >= API_WRITE_LIMIT or queue.empty():
+                    break
+                entry = queue.get_nowait()
+
+            if not pending:
+                continue
+            try:
+                saved = await loop.run_in_executor(executor, organizer.save_classifications, pending, library)
+            except Exception as e:
+                # Keep draining the queue; these papers stay unprocessed and are retried next run
+                print(f"Failed to save classifications for items {sorted(pending)}: {e}")
+                continue
+            for paper_id in saved:
+                state_manager.mark_processed(paper_id, 'classify')
+
+
+def classify_papers(library: ZoteroLibrary, organizer: LibraryOrganizer, state_manager: StateManager, force: bool = False, batch: bool = False) -> None:
     """Classify papers into the current hierarchy."""
     to_process = {}
     
@@ -95,19 +163,36 @@ def classify_papers(library: ZoteroLibrary, organizer: LibraryOrganizer, state_m
         if processed_count > 0:
             print(f"(Skipping {processed_count} already processed papers)")
 
-    for paper_id, paper in to_process.items():
-        print(f"\nProcessing: {paper.title}")
-        organizer.classify_paper_in_collections(paper_id, library, structure_file)
-        
-        # Mark as processed regardless of outcome to prevent infinite loops on unclassifiable items
-        state_manager.mark_processed(paper_id, 'classify')
-        
-        # Determine success for display (this is local only, library.items updated by organizer)
-        current_colls = library.items[paper_id].collections
-        if current_colls:
-            print(f"Classified into: {', '.join(current_colls)}")
-        else:
-            print("Item left unclassified.")
+    if batch:
+        if not to_process:
+            return
+        for paper_id in organizer.classify_papers_in_collections_batch(list(to_process), library):
+            state_manager.mark_processed(paper_id, 'classify')
+        return
+
+    # The collection index is the same for every paper, so build it once
+    collection_index = organizer.build_collection_index(library)
+    if not collection_index.collection_paths:
+        print("Warning: No collections found in library!")
+        return
+
+    async def run():
+        queue = asyncio.Queue()
+        writer = asyncio.create_task(write_classifications(queue, library, organizer, state_manager))
+
+        async def process(paper_id, paper):
+            print(f"\nProcessing: {paper.title}")
+            collection_keys = await organizer.classify_paper_in_collections(paper_id, library, collection_index)
+            await queue.put((paper_id, collection_keys))
+
+        try:
+            await run_bounded(process, to_process.items(), organizer.max_concurrency)
+        finally:
+            # Flush whatever was classified, even if a request failed
+            await queue.put(None)
+            await writer
+
+    asyncio.run(run())
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -117,7 +202,8 @@ def get_parser() -> argparse.ArgumentParser:
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     # Keywords generation
-    subparsers.add_parser("keywords", help="Generate keywords for unclassified papers")
+    keywords_parser = subparsers.add_parser("keywords", help="Generate keywords for unclassified papers")
+    keywords_parser.add_argument("--batch", action="store_true", help="Use the Message Batches API (half price, results may take a while)")
 
     # Collection proposal
     propose_parser = subparsers.add_parser("propose", help="Generate collection structure proposal")
@@ -129,8 +215,10 @@ def get_parser() -> argparse.ArgumentParser:
 
     # Classify papers
     classify_parser = subparsers.add_parser("classify", help="Classify unclassified papers into collections")
-    classify_parser.add_argument("--structure", default="proposal.json", help="Path to collection structure JSON (default: proposal.json)")
+    # Kept so existing invocations don't break; classification reads the collections currently in Zotero
+    classify_parser.add_argument("--structure", default=None, help="Deprecated and ignored: papers are classified into the collections currently in Zotero")
     classify_parser.add_argument("--force", action="store_true", help="Process all papers, including those already in collections")
+    classify_parser.add_argument("--batch", action="store_true", help="Use the Message Batches API (half price, results may take a while)")
     return parser
 
 
@@ -165,13 +253,17 @@ def main():
     state_manager = StateManager()
 
     commands = {
-        "keywords": lambda: generate_keywords(library, organizer, state_manager),
+        "keywords": lambda: generate_keywords(library, organizer, state_manager, args.batch),
         "propose": lambda: propose_collections(library, organizer, args.output),
         "implement": lambda: implement_collections(library, organizer, args.structure),
-        "classify": lambda: classify_papers(library, organizer, state_manager, args.structure, args.force)
+        "classify": lambda: classify_papers(library, organizer, state_manager, args.force, args.batch)
     }
 
-    commands[args.command]()
+    try:
+        commands[args.command]()
+    finally:
+        state_manager.close()
+        organizer.close()
 
 
 
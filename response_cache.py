@@ -0,0 +1,48 @@
+import hashlib
+import json
+import time
+from typing import Optional
+
+from state_manager import connect_local_db
+
+
+class ResponseCache:
+    def __init__(self, db_path: str = "cache.db"):
+        self.db_path = db_path
+        self.conn = connect_local_db(self.db_path)
+        self._init_db()
+
+    def _init_db(self):
+        """Initialize the cached responses database."""
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    ts INTEGER
+                )
+            """)
+
+    @staticmethod
+    def cache_key(params: dict) -> str:
+        """Hash the request parameters (model, messages, temperature, max_tokens, ...)."""
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response text for a key, or None on a miss."""
+        cursor = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, response: str):
+        """Store the response text for a key."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                (key, response, int(time.time()))
+            )
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
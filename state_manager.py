@@ -2,15 +2,29 @@ import sqlite3
 import datetime
 from pathlib import Path
 
+
+def connect_local_db(db_path: str) -> sqlite3.Connection:
+    """Open one of the tool's own SQLite databases (processed items, response cache).
+
+    Callers keep the connection for the whole run; sqlite3 also caches its prepared statements.
+    WAL with synchronous=NORMAL avoids a full fsync on every per-item commit.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
 class StateManager:
     def __init__(self, db_path: str = "processed.db"):
         self.db_path = db_path
+        self.conn = connect_local_db(self.db_path)
         self._init_db()
 
     def _init_db(self):
         """Initialize the processed items database."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
+        with self.conn:
+            self.conn.execute("""
                 CREATE TABLE IF NOT EXISTS processed_items (
                     item_id TEXT,
                     action TEXT,
@@ -21,17 +35,20 @@ class StateManager:
 
     def is_processed(self, item_id: str, action: str) -> bool:
         """Check if an item has already been processed for a specific action."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute(
-                "SELECT 1 FROM processed_items WHERE item_id = ? AND action = ?",
-                (str(item_id), action)
-            )
-            return cursor.fetchone() is not None
+        cursor = self.conn.execute(
+            "SELECT 1 FROM processed_items WHERE item_id = ? AND action = ?",
+            (str(item_id), action)
+        )
+        return cursor.fetchone() is not None
 
     def mark_processed(self, item_id: str, action: str):
         """Mark an item as processed for a specific action."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
+        with self.conn:
+            self.conn.execute(
                 "INSERT OR REPLACE INTO processed_items (item_id, action, timestamp) VALUES (?, ?, ?)",
                 (str(item_id), action, datetime.datetime.now())
             )
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
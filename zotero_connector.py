@@ -1,10 +1,13 @@
 import sqlite3
 import os
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set, Tuple
 from dataclasses import dataclass
 from pyzotero import zotero
 
+# Maximum number of objects the Zotero Web API accepts in one write request
+API_WRITE_LIMIT = 50
+
 
 @dataclass
 class ZoteroItem:
@@ -14,7 +17,7 @@ class ZoteroItem:
     title: str
     keywords: List[str]
     abstract: str
-    collections: List[str]
+    collections: Set[str]
     item_type: str
     metadata: Dict[str, str] = None
 
@@ -142,7 +145,7 @@ class ZoteroLibrary:
         temp_map = {}
         raw_colls = []
         
-        for collection_id, key, name, parent_id in cursor.fetchall():
+        for collection_id, key, name, parent_id in cursor:
             temp_map[collection_id] = key
             self._db_collection_id_map[collection_id] = key
             raw_colls.append((key, name, parent_id))
@@ -152,58 +155,96 @@ class ZoteroLibrary:
             self.collections[key] = ZoteroCollection(key, name, parent_key)
 
     def _load_items(self, conn: sqlite3.Connection) -> None:
+        # Resolve field IDs once instead of once per row inside correlated subqueries
+        field_ids = dict(conn.execute(
+            "SELECT fieldName, fieldID FROM fields WHERE fieldName IN ('title', 'abstractNote', 'extra')"
+        ))
+        title_id = field_ids.get('title')
+        abstract_id = field_ids.get('abstractNote')
+        extra_id = field_ids.get('extra')
+
         type_placeholders = ','.join(['?' for _ in self.item_types])
         cursor = conn.execute(f"""
             SELECT
                 i.itemID, i.key, it.typeName,
-                (SELECT iv.value FROM itemData id JOIN itemDataValues iv ON id.valueID = iv.valueID WHERE id.itemID = i.itemID AND id.fieldID = (SELECT fieldID FROM fields WHERE fieldName = 'title') LIMIT 1) as title,
-                (SELECT iv.value FROM itemData id JOIN itemDataValues iv ON id.valueID = iv.valueID WHERE id.itemID = i.itemID AND id.fieldID = (SELECT fieldID FROM fields WHERE fieldName = 'abstractNote') LIMIT 1) as abstract,
-                (SELECT iv.value FROM itemData id JOIN itemDataValues iv ON id.valueID = iv.valueID WHERE id.itemID = i.itemID AND id.fieldID = (SELECT fieldID FROM fields WHERE fieldName = 'extra') LIMIT 1) as extra,
-                (SELECT GROUP_CONCAT(t.name, '; ') FROM itemTags it JOIN tags t ON it.tagID = t.tagID WHERE it.itemID = i.itemID) as keywords
+                MAX(CASE WHEN id.fieldID = ? THEN iv.value END) as title,
+                MAX(CASE WHEN id.fieldID = ? THEN iv.value END) as abstract,
+                MAX(CASE WHEN id.fieldID = ? THEN iv.value END) as extra,
+                (SELECT GROUP_CONCAT(t.name, '; ') FROM itemTags itg JOIN tags t ON itg.tagID = t.tagID WHERE itg.itemID = i.itemID) as keywords
             FROM items i
             JOIN itemTypes it ON i.itemTypeID = it.itemTypeID
+            JOIN itemData id ON id.itemID = i.itemID AND id.fieldID IN (?, ?, ?)
+            JOIN itemDataValues iv ON id.valueID = iv.valueID
             WHERE it.typeName IN ({type_placeholders})
             AND i.libraryID = ?
-        """, tuple(self.item_types) + (self.library_id,))
+            GROUP BY i.itemID
+        """, (title_id, abstract_id, extra_id, title_id, abstract_id, extra_id)
+             + tuple(self.item_types) + (self.library_id,))
 
-        for item_id, key, item_type, title, abstract, extra, keywords in cursor.fetchall():
+        for item_id, key, item_type, title, abstract, extra, keywords in cursor:
             if title:
                 primary_text = abstract if abstract else (extra or "")
                 keywords_list = keywords.split('; ') if keywords else []
-                self.items[item_id] = ZoteroItem(item_id, key, title, keywords_list, primary_text, [], item_type, {})
+                self.items[item_id] = ZoteroItem(item_id, key, title, keywords_list, primary_text, set(), item_type, {})
 
     def _load_collection_items(self, conn: sqlite3.Connection) -> None:
         """Load relationships. Only useful if collections were loaded from DB."""
-        cursor = conn.execute("SELECT collectionID, itemID FROM collectionItems")
-        for collection_id, item_id in cursor.fetchall():
+        # Filter to this library's collections and the configured item types in SQL,
+        # so attachments, notes and other skipped items are never sent to Python
+        type_placeholders = ','.join(['?' for _ in self.item_types])
+        cursor = conn.execute(f"""
+            SELECT ci.collectionID, ci.itemID
+            FROM collectionItems ci
+            JOIN items i ON ci.itemID = i.itemID
+            JOIN itemTypes it ON i.itemTypeID = it.itemTypeID
+            JOIN collections c ON ci.collectionID = c.collectionID
+            WHERE it.typeName IN ({type_placeholders})
+            AND i.libraryID = ?
+            AND c.libraryID = ?
+        """, tuple(self.item_types) + (self.library_id, self.library_id))
+        for collection_id, item_id in cursor:
             if collection_id in self._db_collection_id_map and item_id in self.items:
                 collection_key = self._db_collection_id_map[collection_id]
                 if collection_key in self.collections:
                     collection = self.collections[collection_key]
                     item = self.items[item_id]
                     collection.items.append(item)
-                    item.collections.append(collection.name)
+                    item.collections.add(collection.name)
 
     def create_collection(self, name: str, parent_key: Optional[str] = None) -> str:
         """Create new collection in Zotero via API. Returns Key."""
+        return self.create_collections([(name, parent_key)])[0]
+
+    def create_collections(self, specs: List[Tuple[str, Optional[str]]]) -> List[str]:
+        """Create (name, parent_key) collections via API, up to 50 per request. Returns Keys in order."""
         if not self.zot: raise RuntimeError("API not initialized")
 
-        payload = {'name': name}
-        if parent_key:
-            if parent_key not in self.collections:
-                raise ValueError(f"Parent {parent_key} not found")
-            payload['parentCollection'] = parent_key
+        payloads = []
+        for name, parent_key in specs:
+            payload = {'name': name}
+            if parent_key:
+                if parent_key not in self.collections:
+                    raise ValueError(f"Parent {parent_key} not found")
+                payload['parentCollection'] = parent_key
+            payloads.append(payload)
 
-        try:
-            resp = self.zot.create_collections([payload])
-            if resp and 'successful' in resp and resp['successful']:
-                new_key = list(resp['successful'].keys())[0]
-                self.collections[new_key] = ZoteroCollection(new_key, name, parent_key)
-                return new_key
-            else:
-                raise RuntimeError(f"Failed to create collection: {resp}")
-        except Exception as e:
-            raise RuntimeError(f"API Error: {e}")
+        keys = []
+        for start in range(0, len(payloads), API_WRITE_LIMIT):
+            chunk = payloads[start:start + API_WRITE_LIMIT]
+            try:
+                resp = self.zot.create_collections(chunk)
+            except Exception as e:
+                raise RuntimeError(f"API Error: {e}")
+
+            # 'successful' is keyed by the payload index within the request
+            successful = resp.get('successful', {}) if resp else {}
+            if len(successful) != len(chunk):
+                raise RuntimeError(f"Failed to create collections: {resp}")
+            for i, payload in enumerate(chunk):
+                new_key = successful[str(i)]['key']
+                self.collections[new_key] = ZoteroCollection(new_key, payload['name'], payload.get('parentCollection'))
+                keys.append(new_key)
+        return keys
 
     def delete_collection(self, collection_key: str) -> None:
         if collection_key not in self.collections: raise ValueError("Collection not found")
@@ -213,8 +254,7 @@ class ZoteroLibrary:
             self.zot.delete_collection(collection_key)
             coll = self.collections.pop(collection_key)
             for item in coll.items:
-                if coll.name in item.collections:
-                    item.collections.remove(coll.name)
+                item.collections.discard(coll.name)
         except Exception as e:
             raise RuntimeError(f"API Error: {e}")
 
@@ -234,16 +274,57 @@ class ZoteroLibrary:
         try:
             # We must fetch the item to update it safely
             current = self.zot.item(item.key)
-            # update_item expects the 'data' content, not the full wrapper
+            # update_item expects the 'data' content, not the full wrapper;
+            # unlike update_items it raises when the write is rejected
             item_data = current['data']
             item_data['collections'] = collection_keys
             self.zot.update_item(item_data)
-            
+
             # Update local
-            item.collections = [self.collections[k].name for k in collection_keys if k in self.collections]
+            item.collections = {self.collections[k].name for k in collection_keys if k in self.collections}
         except Exception as e:
             raise RuntimeError(f"API Error: {e}")
 
+    def update_items_collections(self, updates: Dict[int, List[str]]) -> List[int]:
+        """Set the collections of several items (item_id -> keys), up to 50 items per API request.
+
+        Returns the IDs of the items that were actually written; only those are updated locally.
+        A chunk whose request fails is reported and skipped, so the other chunks still go through.
+        """
+        if any(item_id not in self.items for item_id in updates): raise ValueError("Item not found")
+        if not self.zot: raise RuntimeError("API not initialized")
+
+        written = []
+        item_ids = list(updates)
+        for start in range(0, len(item_ids), API_WRITE_LIMIT):
+            ids_by_key = {self.items[item_id].key: item_id for item_id in item_ids[start:start + API_WRITE_LIMIT]}
+            try:
+                # We must fetch the items to update them safely
+                current = self.zot.items(itemKey=','.join(ids_by_key), limit=API_WRITE_LIMIT)
+                # update_items expects the 'data' content, not the full wrapper
+                payload = []
+                for entry in current:
+                    item_data = entry['data']
+                    item_data['collections'] = updates[ids_by_key[item_data['key']]]
+                    payload.append(item_data)
+                self.zot.update_items(payload)
+
+                # update_items only checks the HTTP status and ignores per-item failures
+                # (e.g. version conflicts), so read the items back to see which were written
+                stored = self.zot.items(itemKey=','.join(ids_by_key), limit=API_WRITE_LIMIT)
+            except Exception as e:
+                print(f"API Error updating {len(ids_by_key)} items: {e}")
+                continue
+
+            for entry in stored:
+                item_id = ids_by_key.get(entry['data']['key'])
+                if item_id is not None and set(entry['data'].get('collections', [])) == set(updates[item_id]):
+                    # Update local
+                    self.items[item_id].collections = {self.collections[k].name for k in updates[item_id] if k in self.collections}
+                    written.append(item_id)
+
+        return written
+
     def update_item_keywords(self, item_id: int, new_keywords: List[str]) -> None:
         if item_id not in self.items: raise ValueError("Item not found")
         if not self.zot: raise RuntimeError("API not initialized")
@@ -251,18 +332,23 @@ class ZoteroLibrary:
         item = self.items[item_id]
         try:
             zotero_item = self.zot.item(item.key)
-            if 'data' in zotero_item and 'deleted' in zotero_item['data']:
-                del zotero_item['data']['deleted']
-            self.zot.add_tags(zotero_item, *new_keywords)
-            item.keywords = list(set(item.keywords + new_keywords))
+            item_data = zotero_item['data']
+            if 'deleted' in item_data:
+                del item_data['deleted']
+
+            # Merge all new tags in one pass and write once; skip the request if nothing changed
+            tags = item_data.get('tags', [])
+            existing = {t['tag'] for t in tags}
+            added = [k for k in dict.fromkeys(new_keywords) if k not in existing]
+            if added:
+                item_data['tags'] = tags + [{'tag': k} for k in added]
+                self.zot.update_item(item_data)
+            item.keywords = list(dict.fromkeys(item.keywords + new_keywords))
         except Exception as e:
             raise RuntimeError(f"API Error: {e}")
 
     def get_all_keywords(self) -> set[str]:
-        all_keywords = set()
-        for item in self.items.values():
-            all_keywords.update(item.keywords)
-        return all_keywords
+        return set().union(*(item.keywords for item in self.items.values()))
 
     def delete_all_collections(self) -> None:
         if not self.zot: raise RuntimeError("API not initialized")
@@ -282,25 +368,27 @@ class ZoteroLibrary:
             item.collections.clear()
 
     def create_collection_structure(self, structure, parent_key: Optional[str] = None) -> Dict[str, str]:
-        """Create structure. Returns Name -> Key map."""
+        """Create structure one tree level at a time, batching each level's API writes. Returns Name -> Key map."""
         collection_map = {}
-        
-        if isinstance(structure, list):
-            for item in structure:
-                if isinstance(item, dict) and 'name' in item:
-                    name = item['name']
-                    key = self.create_collection(name, parent_key)
-                    collection_map[name] = key
-                    if 'subcollections' in item:
-                        sub_map = self.create_collection_structure(item['subcollections'], key)
-                        collection_map.update(sub_map)
-        
-        elif isinstance(structure, dict):
-            for name, content in structure.items():
-                key = self.create_collection(name, parent_key)
+        level = [(structure, parent_key)]
+
+        while level:
+            # Collect (name, parent_key, substructure) for every node on this level
+            nodes = []
+            for substructure, parent in level:
+                if isinstance(substructure, list):
+                    for item in substructure:
+                        if isinstance(item, dict) and 'name' in item:
+                            nodes.append((item['name'], parent, item.get('subcollections')))
+                elif isinstance(substructure, dict):
+                    for name, content in substructure.items():
+                        nodes.append((name, parent, content if isinstance(content, dict) else None))
+
+            keys = self.create_collections([(name, parent) for name, parent, _ in nodes])
+            level = []
+            for (name, _, substructure), key in zip(nodes, keys):
                 collection_map[name] = key
-                if isinstance(content, dict):
-                    sub_map = self.create_collection_structure(content, key)
-                    collection_map.update(sub_map)
-                    
+                if substructure:
+                    level.append((substructure, key))
+
         return collection_map